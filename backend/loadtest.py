@@ -0,0 +1,277 @@
+"""
+load test for the analyze_book endpoint.
+
+by default everything runs locally: a stub Gutenberg server, a stub OpenAI
+server (with fake latency) and the real endpoint code (handle_analysis with
+the modal functions run via .local()) behind uvicorn. pass --url to hit a
+deployed endpoint instead.
+
+spacy and hybrid requests run spaCy in-process, so they need en_core_web_sm
+installed (see requirements.txt). hybrid also needs tiktoken's o200k_base
+file, it's downloaded on first use (or read from TIKTOKEN_CACHE_DIR). if that
+fails offline the harness falls back to a ~4 chars/token estimate and says so.
+
+latency is measured from each request's scheduled send time, so time spent
+waiting for a free --max-in-flight worker counts. sends that started late
+are reported separately.
+
+    python loadtest.py --rps 5 --duration 30 --mix llm=3,hybrid=1
+    python loadtest.py --limits llm=1 --admission-timeout 2 --rps 10
+    python loadtest.py --url https://<you>--llm-idea-analyze-book.modal.run --rps 1
+"""
+import argparse
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+NAMES = [
+    "Elizabeth Bennet", "Mr. Darcy", "Jane Bennet", "Charles Bingley", "Mr. Collins",
+    "Lydia Bennet", "George Wickham", "Charlotte Lucas", "Lady Catherine", "Mrs. Bennet",
+]
+VERBS = ["spoke with", "walked beside", "argued with", "laughed at", "wrote to", "danced with"]
+LATE_SEND = 0.05   # seconds behind schedule before a send counts as delayed
+
+
+def fake_book(book_id: int, chars: int) -> str:
+    rnd = random.Random(book_id)
+    out, size = [], 0
+    while size < chars:
+        a, b = rnd.sample(NAMES, 2)
+        sent = f"{a} {rnd.choice(VERBS)} {b} in the drawing room. "
+        out.append(sent)
+        size += len(sent)
+    return (
+        f"*** START OF THE PROJECT GUTENBERG EBOOK {book_id} ***\n"
+        + "".join(out)
+        + f"\n*** END OF THE PROJECT GUTENBERG EBOOK {book_id} ***\n"
+    )
+
+
+def start_server(handler, port: int = 0) -> ThreadingHTTPServer:
+    srv = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+
+def gutenberg_handler(book_chars: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            m = re.match(r"/files/(\d+)/\d+-0\.txt", self.path)
+            if m:
+                body = fake_book(int(m.group(1)), book_chars).encode()
+            elif self.path.startswith("/ebooks/"):
+                book_id = self.path.rsplit("/", 1)[-1]
+                body = f"<html><title>Book {book_id} by Stub Author | Project Gutenberg</title></html>".encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def openai_handler(latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            req = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            time.sleep(latency * random.uniform(0.5, 1.5))
+
+            sys_prompt = req["messages"][0]["content"]
+            if '"map"' in sys_prompt:   # clean_graph_with_llm
+                content = {"map": {}}
+            else:                       # analyse_chunk
+                a, b = random.sample(NAMES, 2)
+                content = {"nodes": [[a, 3], [b, 2]], "edges": [[a, b, 1]]}
+
+            body = json.dumps({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": req["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": json.dumps(content)},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def parse_pairs(spec: str, cast=int) -> dict:
+    # "llm=3,spacy=1" -> {"llm": 3, "spacy": 1}
+    return {k.strip(): cast(v) for k, v in (p.split("=") for p in spec.split(",") if p)}
+
+
+def start_local_endpoint(args) -> str:
+    gut = start_server(gutenberg_handler(args.book_chars))
+    oai = start_server(openai_handler(args.llm_latency))
+
+    # has to happen before updated_main is imported, it reads these at import time
+    os.environ["GUTENBERG_URL"] = f"http://127.0.0.1:{gut.server_port}"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{oai.server_port}/v1"
+    os.environ["OPENAI_API_KEY"] = "stub"
+
+    import uvicorn
+    from fastapi import FastAPI, Request
+
+    import updated_main as um
+
+    # keep the corpus index in memory instead of spawning the real index_writer,
+    # the lock plays the part of its single container
+    um.corpus_store = {}
+    index_lock = threading.Lock()
+
+    def store_graph(*args):
+        with index_lock:
+            um.index_book(um.corpus_store, *args)
+
+    um.store_graph = store_graph
+
+    # pick_passages needs the BPE file, which can't be fetched offline
+    try:
+        um.tiktoken.encoding_for_model(um.MODEL)
+    except Exception as e:
+        print(f"tiktoken unavailable ({type(e).__name__}), hybrid uses a ~4 chars/token estimate")
+        approx = SimpleNamespace(encode=lambda text: range(len(text) // 4))
+        um.tiktoken = SimpleNamespace(encoding_for_model=lambda model: approx)
+
+    if args.limits:
+        um.MODE_LIMITS.update(parse_pairs(args.limits))
+        um._mode_slots = {m: threading.BoundedSemaphore(n) for m, n in um.MODE_LIMITS.items()}
+    if args.admission_timeout is not None:
+        um.ADMISSION_TIMEOUT = args.admission_timeout
+
+    api = FastAPI()
+
+    @api.post("/")
+    def analyze(req: um.AnalysisRequest, request: Request):
+        return um.handle_analysis(req, request.headers.get("accept-encoding", ""), local=True)
+
+    server = uvicorn.Server(uvicorn.Config(api, host="127.0.0.1", port=args.port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+
+    print(f"local endpoint on :{args.port}, limits {um.MODE_LIMITS}, admission timeout {um.ADMISSION_TIMEOUT}s")
+    return f"http://127.0.0.1:{args.port}/"
+
+
+def percentile(xs: list[float], q: float) -> float:
+    if not xs:
+        return float("nan")
+    # nearest rank
+    xs = sorted(xs)
+    return xs[max(0, math.ceil(q * len(xs)) - 1)]
+
+
+def run(url: str, args) -> dict:
+    mix = parse_pairs(args.mix)
+    modes, weights = list(mix), list(mix.values())
+    books = [int(b) for b in args.books.split(",")]
+    total = int(args.rps * args.duration)
+
+    results = defaultdict(list)   # mode -> [(status, latency, send lag)]
+    lock = threading.Lock()
+
+    def one(mode: str, book_id: int, scheduled: float):
+        lag = time.perf_counter() - scheduled
+        try:
+            r = requests.post(url, json={"gutenberg_id": book_id, "analysis_type": mode},
+                              timeout=args.timeout)
+            status = r.status_code
+            if status == 200 and "error" in r.json():
+                status = "error"
+        except requests.RequestException:
+            status = "exception"
+        with lock:
+            results[mode].append((status, time.perf_counter() - scheduled, lag))
+
+    # open loop: the schedule doesn't wait for responses. if every worker is
+    # busy a send goes out late, that lag is part of its latency and is reported
+    print(f"sending {total} requests at {args.rps} rps, mix {mix}")
+    rnd = random.Random(args.seed)
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.max_in_flight) as pool:
+        for i in range(total):
+            scheduled = t_start + i / args.rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one, rnd.choices(modes, weights)[0], rnd.choice(books), scheduled)
+    elapsed = time.perf_counter() - t_start
+
+    return {"elapsed": elapsed, "results": results}
+
+
+def report(out: dict):
+    print(f"\nfinished in {out['elapsed']:.1f}s\n")
+    print(f"{'mode':<8}{'n':>6}{'ok':>6}{'429':>6}{'err':>6}{'err%':>7}"
+          f"{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}")
+    for mode, rows in sorted(out["results"].items()):
+        ok = [lat for st, lat, _ in rows if st == 200]
+        throttled = sum(1 for st, _, _ in rows if st == 429)
+        errors = len(rows) - len(ok) - throttled
+        print(f"{mode:<8}{len(rows):>6}{len(ok):>6}{throttled:>6}{errors:>6}"
+              f"{100 * errors / len(rows):>6.1f}%"
+              f"{percentile(ok, 0.5):>8.2f}{percentile(ok, 0.9):>8.2f}"
+              f"{percentile(ok, 0.99):>8.2f}{max(ok, default=float('nan')):>8.2f}")
+    print("\nlatencies in seconds from scheduled send, successful requests only")
+
+    lags = [lag for rows in out["results"].values() for _, _, lag in rows]
+    late = [lag for lag in lags if lag > LATE_SEND]
+    if late:
+        print(f"{len(late)}/{len(lags)} sends went out >{LATE_SEND * 1000:.0f}ms late "
+              f"(max {max(late):.2f}s), raise --max-in-flight if the client is the bottleneck")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="load test analyze_book")
+    ap.add_argument("--url", help="hit this endpoint instead of starting a local one")
+    ap.add_argument("--rps", type=float, default=2.0)
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of traffic")
+    ap.add_argument("--mix", default="llm=1", help="analysis_type weights, e.g. llm=3,spacy=1,hybrid=1")
+    ap.add_argument("--books", default="1342,84,11,2701", help="gutenberg ids to pick from")
+    ap.add_argument("--timeout", type=float, default=300.0, help="client timeout per request")
+    ap.add_argument("--max-in-flight", type=int, default=256)
+    ap.add_argument("--seed", type=int, default=0)
+    # local mode only
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--limits", help="override MODE_LIMITS, e.g. llm=1,spacy=2")
+    ap.add_argument("--admission-timeout", type=float)
+    ap.add_argument("--llm-latency", type=float, default=1.0, help="mean stub OpenAI latency (s)")
+    ap.add_argument("--book-chars", type=int, default=200_000)
+    args = ap.parse_args()
+
+    url = args.url or start_local_endpoint(args)
+    report(run(url, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,11 @@
 import json
+import math
 import os
 import re
+import threading
 import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import Counter, defaultdict, deque
 from pathlib import Path
 from typing import Literal
@@ -10,8 +14,9 @@ import modal
 import requests
 import tiktoken
 from dotenv import load_dotenv
+from fastapi import HTTPException, Request, Response
 from openai import OpenAI
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, NonNegativeInt, ValidationError
 
 
 load_dotenv()
@@ -21,6 +26,19 @@ MAX_EXCERPT_CHARS = 15000
 CHUNK_CHARS = 2200
 OVERLAP_CHARS = 200
 SKIP = 0.05      
+HYBRID_TOKEN_BUDGET = 12000   # prompt tokens spent on passages in hybrid mode
+NOVELTY_BONUS = 3             # extra score for a pair no chosen passage covers yet
+ALIAS_NAMES = 80              # most mentioned names sent to the alias clean-up, so the reply fits
+LLM_WORKERS = 4               # chunk requests in flight at once
+CHUNK_RETRIES = 1             # re-ask the LLM this many times if a reply can't be used
+
+# admission control for analyze_book: analyses running at once per mode,
+# and how long a request may wait for a slot before it gets a 429
+MODE_LIMITS = {"spacy": 4, "llm": 2, "hybrid": 2}
+ADMISSION_TIMEOUT = 20
+ADMISSION_QUEUE = 120         # requests allowed to wait in admit() on top of the running ones
+
+GUTENBERG_URL = os.getenv("GUTENBERG_URL", "https://www.gutenberg.org")
 
 
 
@@ -35,12 +53,35 @@ image = (
     .run_commands("python -m spacy download en_core_web_sm")
 )
 app = modal.App("llm_idea", image=image)
+corpus_store = modal.Dict.from_name("book-graphs", create_if_missing=True)
+
 
+# server side trimming + shape of the graph that gets sent back
+class GraphOptions(BaseModel):
+    max_nodes: int | None = Field(default=None, ge=1)
+    max_edges: int | None = Field(default=None, ge=1)
+    min_weight: int = Field(default=0, ge=0)
+    compact: bool = False    # node table + [source_idx, target_idx, weight] edges
 
-class AnalysisRequest(BaseModel):
+
+class AnalysisRequest(GraphOptions):
     gutenberg_id: int
-    analysis_type: Literal["spacy", "llm", "metadata"]
+    analysis_type: Literal["spacy", "llm", "hybrid", "metadata"]
     max_chunks: int = 5
+    wire_format: Literal["json", "msgpack"] = "json"
+
+
+class CorpusRequest(GraphOptions):
+    query_type: Literal["character", "author", "book"]
+    name: str | None = None          # character or author name
+    gutenberg_id: int | None = None
+    top_partners: int = 10
+
+
+# what one analyse_chunk reply should look like
+class ChunkGraph(BaseModel):
+    nodes: list[tuple[str, NonNegativeInt]] = []
+    edges: list[tuple[str, str, NonNegativeInt]] = []
 
 
 # remove the headers 
@@ -59,7 +100,7 @@ def core_text(txt: str) -> str:
 
 
 def get_text(gutenberg_id: int):
-    url = f"https://www.gutenberg.org/files/{gutenberg_id}/{gutenberg_id}-0.txt"
+    url = f"{GUTENBERG_URL}/files/{gutenberg_id}/{gutenberg_id}-0.txt"
     try:
         r = requests.get(url, timeout=30)
         r.raise_for_status()
@@ -111,8 +152,7 @@ def build_system_prompt(title: str, author: str) -> str:
 
 # clean up with LLM to fix mistakes 
 
-def clean_graph_with_llm(nodes: list[dict], edges: list[dict],
-                         title: str, author: str) -> tuple[list, list]:
+def alias_map(nodes: list[dict], title: str, author: str) -> dict:
     from openai import OpenAI
     client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     
@@ -133,50 +173,74 @@ def clean_graph_with_llm(nodes: list[dict], edges: list[dict],
         "Character list (name: mentions):\n" + raw_node_str
     )
 
-    rsp = client.chat.completions.create(
-        model=MODEL,
-        messages=[{"role": "system", "content": sys},
-                  {"role": "user", "content": user}],
-        temperature=0.0,
-        max_tokens=800,
-        response_format={"type": "json_object"},
-    )
+    # a bad clean-up reply shouldn't throw away the chunk calls we already paid for
+    try:
+        rsp = client.chat.completions.create(
+            model=MODEL,
+            messages=[{"role": "system", "content": sys},
+                      {"role": "user", "content": user}],
+            temperature=0.0,
+            max_tokens=2000,
+            response_format={"type": "json_object"},
+        )
+        mapping = json.loads(rsp.choices[0].message.content)["map"]
+    except Exception as e:
+        print(f"[alias_map] clean-up failed: {e} – keeping names as they are")
+        return {}
 
-    mapping = json.loads(rsp.choices[0].message.content)["map"]
+    if not isinstance(mapping, dict):
+        print("[alias_map] unexpected response schema, keeping names as they are")
+        return {}
+    mapping = {k: v for k, v in mapping.items() if isinstance(v, str) and v}
+    if not mapping:
+        print("[alias_map] empty map, aliases won't be merged")
+    return mapping
 
-    # combine nodes
-    merged_counts = Counter()
-    for n in nodes:
-        canon = mapping.get(n["name"], n["name"])
-        merged_counts[canon] += n["count"]
 
-    cleaned_nodes = [
-        {"name": name, "count": cnt}
-        for name, cnt in merged_counts.most_common(50)
-    ]
-    top_character_names = {node["name"] for node in cleaned_nodes}
+def apply_alias_map(nodes: list[dict], edges: list[dict], mapping: dict):
+    # canonical name totals, no caps yet
+    node_ctr: Counter[str] = Counter()
+    for n in nodes:
+        node_ctr[mapping.get(n["name"], n["name"])] += n["count"]
 
-    # combine edges
     edge_ctr: Counter[tuple[str, str]] = Counter()
     for e in edges:
         a = mapping.get(e["source"], e["source"])
         b = mapping.get(e["target"], e["target"])
-        if a in top_character_names and b in top_character_names and a != b:
+        if a != b:
             edge_ctr[tuple(sorted((a, b)))] += e["weight"]
 
+    return node_ctr, edge_ctr
+
+
+def top_graph(node_ctr: Counter, edge_ctr: Counter) -> tuple[list, list]:
+    cleaned_nodes = [
+        {"name": name, "count": cnt}
+        for name, cnt in node_ctr.most_common(50)
+    ]
+    top_character_names = {node["name"] for node in cleaned_nodes}
+
     cleaned_edges = [
         {"source": a, "target": b, "weight": w}
         for (a, b), w in sorted(edge_ctr.items(), key=lambda x: x[1], reverse=True)
+        if a in top_character_names and b in top_character_names
     ][:200]
 
     return cleaned_nodes, cleaned_edges
 
 
+def clean_graph_with_llm(nodes: list[dict], edges: list[dict],
+                         title: str, author: str) -> tuple[list, list]:
+    top = sorted(nodes, key=lambda n: n["count"], reverse=True)[:ALIAS_NAMES]
+    mapping = alias_map(top, title, author)
+    return top_graph(*apply_alias_map(nodes, edges, mapping))
+
+
 
 
 def get_meta_data(id: int):
     
-    m = requests.get(f"https://www.gutenberg.org/ebooks/{id}")
+    m = requests.get(f"{GUTENBERG_URL}/ebooks/{id}")
 
 
     html = m.text
@@ -209,32 +273,429 @@ def analyse_chunk(txt: str, sys_prompt: str) -> str:
     return rsp.choices[0].message.content
 
 
-def merge(results: list[str]):
+def parse_chunk(raw: str) -> ChunkGraph | None:
+    """
+    parse + validate one chunk reply. tries to repair it first (text around
+    the json, single bad items) and only gives up (None) if nothing is usable
+    """
+    try:
+        d = json.loads(raw)
+    except (TypeError, json.JSONDecodeError):
+        m = re.search(r"\{.*\}", raw or "", re.S)
+        if not m:
+            return None
+        try:
+            d = json.loads(m.group(0))
+        except json.JSONDecodeError:
+            return None
+
+    if not isinstance(d, dict):
+        return None
 
-    node_ctr: Counter[str] = Counter()
-    edge_ctr: Counter[tuple[str, str]] = Counter()
+    try:
+        return ChunkGraph(**d)
+    except ValidationError:
+        pass
+
+    # keep whatever items are fine, drop the rest
+    def valid(field, item):
+        try:
+            ChunkGraph(**{field: [item]})
+            return True
+        except ValidationError:
+            return False
+
+    def items(field):
+        v = d.get(field)
+        return v if isinstance(v, list) else []
+
+    nodes = [n for n in items("nodes") if valid("nodes", n)]
+    edges = [e for e in items("edges") if valid("edges", e)]
+    if not nodes and not edges:
+        return None
+    return ChunkGraph(nodes=nodes, edges=edges)
+
+
+class GraphMerger:
+    """running totals of chunk graphs, fed one chunk at a time as they finish"""
+
+    def __init__(self, top_nodes: int = 50, top_edges: int = 200):
+        self.top_nodes = top_nodes
+        self.top_edges = top_edges
+        self.node_ctr: Counter[str] = Counter()
+        self.edge_ctr: Counter[tuple[str, str]] = Counter()
+        self.merged = 0
+
+    def add(self, raw: str) -> bool:
+        g = parse_chunk(raw)
+        if g is None:
+            return False
+        for n, c in g.nodes:
+            self.node_ctr[n] += c
+        for a, b, w in g.edges:
+            if a != b:
+                self.edge_ctr[tuple(sorted((a, b)))] += w
+        self.merged += 1
+        return True
+
+    def result(self):
+        nodes = [{"name": n, "count": c} for n, c in self.node_ctr.most_common(self.top_nodes)]
+        edges = [
+            {"source": a, "target": b, "weight": w}
+            for (a, b), w in self.edge_ctr.most_common(self.top_edges)
+        ]
+        return nodes, edges
+
+
+def analyse_chunks(chunks: list[str], sys_prompt: str):
+    """
+    sends chunks to the LLM in parallel and merges each reply as soon as it
+    comes back. a chunk that errors or returns garbage is retried on its own,
+    if it still fails it's dropped instead of killing the whole run.
+    """
+    merger = GraphMerger()
+    attempts = Counter()
+    failed = 0
+
+    with ThreadPoolExecutor(max_workers=LLM_WORKERS) as pool:
+        pending = {pool.submit(analyse_chunk, ch, sys_prompt): i for i, ch in enumerate(chunks)}
+        while pending:
+            for fut in as_completed(list(pending)):
+                i = pending.pop(fut)
+                try:
+                    ok = merger.add(fut.result())
+                except Exception as e:
+                    print(f"[analyse_chunks] chunk {i} request failed: {e}")
+                    ok = False
+
+                if ok:
+                    continue
+                if attempts[i] < CHUNK_RETRIES:
+                    attempts[i] += 1
+                    print(f"[analyse_chunks] retrying chunk {i}")
+                    pending[pool.submit(analyse_chunk, chunks[i], sys_prompt)] = i
+                else:
+                    failed += 1
+
+    print(f"\nMerged {merger.merged}/{len(chunks)} chunks ({failed} dropped)")
+    return merger.result()
+
+
+
+def load_nlp():
+    import spacy
+    print("\nInitializing spaCy...")
+    # Use smaller CPU-optimized model
+    nlp = spacy.load("en_core_web_sm", disable=["tagger", "parser", "attribute_ruler", "lemmatizer"])
+    nlp.add_pipe("sentencizer")
+    print("Model loaded successfully")
+    return nlp
 
-    for raw in results:
-        d = json.loads(raw)
-        for n, c in d["nodes"]:
-            node_ctr[n] += int(c)
-        for a, b, w in d["edges"]:
-            edge = tuple(sorted((a, b)))
-            edge_ctr[edge] += int(w)
 
-    top_nodes = node_ctr.most_common(50)
-    top_edges = sorted(edge_ctr.items(), key=lambda x: x[1], reverse=True)[:200]
+def spacy_cooccurrence(raw_text: str):
+    """
+    one spaCy pass over the whole book.
+    returns mention counts, sentence level pair counts and, per passage of
+    CHUNK_CHARS, which pairs co-occur there (so we know where the interactions are)
+    """
+    from itertools import combinations
+
+    nlp = load_nlp()
+
+    blocks = [raw_text[i:i+50000] for i in range(0, len(raw_text), 50000)]
+    print(f"\nSplit text into {len(blocks)} blocks")
+
+    # we create two counters for each of pairs and overall number of mentions
+    mention_counter: Counter[str] = Counter()
+    pair_counter: Counter[tuple[str, str]] = Counter()
+    passage_pairs: defaultdict[int, Counter[tuple[str, str]]] = defaultdict(Counter)
+
+    for i, doc in enumerate(nlp.pipe(blocks, batch_size=2048)):
+        # Count overall mentions across the block
+        for ent in doc.ents:
+            if ent.label_ == "PERSON":
+                mention_counter[ent.text.strip()] += 1
+
+        # Count interactions per sentence 
+        for sent in doc.sents:
+            names = {e.text.strip() for e in sent.ents if e.label_ == "PERSON"}
+            if len(names) > 1:
+                passage = (i * 50000 + sent.start_char) // CHUNK_CHARS
+                for n1, n2 in combinations(sorted(list(names)), 2):
+                    pair_counter[(n1, n2)] += 1 
+                    passage_pairs[passage][(n1, n2)] += 1
+
+    return mention_counter, pair_counter, passage_pairs
+
+
+def passage_text(text: str, idx: int) -> str:
+    # same overlap as make_chunks so dialogue at the edges isn't cut off
+    lo = max(0, idx * CHUNK_CHARS - OVERLAP_CHARS)
+    hi = min(len(text), (idx + 1) * CHUNK_CHARS + OVERLAP_CHARS)
+    return text[lo:hi]
+
+
+def pick_passages(text: str, passage_pairs: dict, token_budget: int = HYBRID_TOKEN_BUDGET) -> list[int]:
+    """
+    greedy: take the passage with the most co-occurrences, pairs nobody picked
+    yet get a bonus so we don't spend the whole budget on the same two people.
+    stops once the passages would go over token_budget.
+    """
+    enc = tiktoken.encoding_for_model(MODEL)
+    covered: set[tuple[str, str]] = set()
+    remaining = dict(passage_pairs)
+    picked, spent = [], 0
+
+    while remaining:
+        def score(idx):
+            pairs = remaining[idx]
+            return sum(pairs.values()) + NOVELTY_BONUS * sum(1 for p in pairs if p not in covered)
+
+        best = max(remaining, key=score)
+        pairs = remaining.pop(best)
+        cost = len(enc.encode(passage_text(text, best)))
+        # passages are all about the same size, if this one doesn't fit none will
+        if spent + cost > token_budget:
+            break
+        picked.append(best)
+        covered.update(pairs)
+        spent += cost
+
+    print(f"\nPicked {len(picked)} passages (~{spent} tokens) out of {len(passage_pairs)} with interactions")
+    return sorted(picked)
+
+
+def shape_graph(book_id: int, nodes: list[dict], edges: list[dict],
+                opts: GraphOptions | None = None) -> dict:
+    """
+    applies limits/threshold before the graph leaves the container,
+    optionally in the compact form:
+    {"nodes": [name, ...], "counts": [...], "edges": [[i, j, weight], ...]}
+    """
+    opts = opts or GraphOptions()
+
+    nodes = sorted(nodes, key=lambda n: n["count"], reverse=True)[:opts.max_nodes]
+    keep = {n["name"] for n in nodes}
+
+    edges = [e for e in edges if e["weight"] >= opts.min_weight]
+    if opts.max_nodes is not None or opts.compact:
+        edges = [e for e in edges if e["source"] in keep and e["target"] in keep]
+    edges = sorted(edges, key=lambda e: e["weight"], reverse=True)[:opts.max_edges]
+
+    if not opts.compact:
+        return {"book_id": book_id, "nodes": nodes, "edges": edges}
+
+    idx = {n["name"]: i for i, n in enumerate(nodes)}
+    return {
+        "book_id": book_id,
+        "format": "compact",
+        "nodes": [n["name"] for n in nodes],
+        "counts": [n["count"] for n in nodes],
+        "edges": [[idx[e["source"]], idx[e["target"]], e["weight"]] for e in edges],
+    }
+
+
+def pick_encoding(accept_encoding: str, supported: tuple[str, ...] = ("br", "gzip")) -> str | None:
+    # highest q wins, ties go to the order in supported. "*" covers codings not listed
+    q_values = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, val = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(val)
+                except ValueError:
+                    q = 0.0
+        if name:
+            q_values[name.strip()] = q
+
+    best, best_q = None, 0.0
+    for coding in supported:
+        q = q_values.get(coding, q_values.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def encode_response(payload: dict, accept_encoding: str, wire_format: str = "json") -> Response:
+    """serialize once ourselves so we can pick msgpack and compress the body"""
+    if wire_format == "msgpack":
+        import msgpack
+        body = msgpack.packb(payload, use_bin_type=True)
+        media_type = "application/x-msgpack"
+    else:
+        body = json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode()
+        media_type = "application/json"
+
+    headers = {"Vary": "Accept-Encoding"}
+    if len(body) > 1024:    # not worth it for tiny bodies
+        coding = pick_encoding(accept_encoding)
+        if coding == "br":
+            import brotli
+            body = brotli.compress(body, quality=5)
+            headers["Content-Encoding"] = "br"
+        elif coding == "gzip":
+            import gzip
+            body = gzip.compress(body, compresslevel=6)
+            headers["Content-Encoding"] = "gzip"
+
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+# ---- corpus index ----
+# every analysed book is folded into corpus_store as it finishes, so lookups
+# are single key reads and series graphs never need the books re-analysed.
+# updates are read-modify-write on shared keys, so they all go through the
+# single index_writer container one book at a time.
+#   book:<id>     -> {"title", "author", "nodes", "edges"}   (graph as analysed)
+#   char:<name>   -> {"name", "names": {id: display}, "books": {id: count},
+#                     "partners": {name: weight}, "partner_names": {name: display}}
+#   author:<name> -> {"author", "books": [ids], "nodes": Counter, "edges": Counter,
+#                     "names": {name: {id: display}}}
+# <name> and every name used as a key inside the entries go through norm_name,
+# the display spelling is kept per book so removing a book can't leave a stale one.
+
+def norm_name(name: str) -> str:
+    return " ".join(name.lower().split())
+
+
+def _fold_book(store, book_id: int, author: str, nodes: list[dict], edges: list[dict], sign: int):
+    # sign=-1 takes a previous version of the book back out before re-adding it
+    display: dict[str, str] = {}
+    partners: defaultdict[str, Counter[str]] = defaultdict(Counter)
+    for e in edges:
+        a, b = norm_name(e["source"]), norm_name(e["target"])
+        if a == b:
+            continue
+        display.setdefault(a, e["source"])
+        display.setdefault(b, e["target"])
+        partners[a][b] += e["weight"]
+        partners[b][a] += e["weight"]
+
+    for n in nodes:
+        norm = norm_name(n["name"])
+        key = f"char:{norm}"
+        entry = store.get(key) or {"name": n["name"], "names": {}, "books": {},
+                                   "partners": {}, "partner_names": {}}
+        books = Counter(entry["books"])
+        books[book_id] += sign * n["count"]
+        ptr = Counter(entry["partners"])
+        ptr.update({p: sign * w for p, w in partners[norm].items()})
+        names = dict(entry["names"])
+        partner_names = dict(entry["partner_names"])
+        if sign > 0:
+            names[book_id] = n["name"]
+            partner_names.update({p: display[p] for p in partners[norm]})
+        else:
+            names.pop(book_id, None)
+
+        entry["books"] = {b: c for b, c in books.items() if c > 0}
+        entry["partners"] = {p: w for p, w in ptr.items() if w > 0}
+        entry["names"] = {b: names[b] for b in entry["books"] if b in names}
+        entry["partner_names"] = {p: partner_names[p] for p in entry["partners"] if p in partner_names}
+        if entry["books"]:
+            # spelling from the book that mentions them most
+            top = max(entry["names"], key=entry["books"].get, default=None)
+            entry["name"] = entry["names"][top] if top is not None else entry["name"]
+            store[key] = entry
+        elif key in store:    # character isn't in any book anymore
+            del store[key]
+
+    key = f"author:{norm_name(author)}"
+    if key == "author:unknown":
+        return
+    series = store.get(key) or {"author": author, "books": [], "nodes": Counter(),
+                                "edges": Counter(), "names": {}}
+    for n in nodes:
+        norm = norm_name(n["name"])
+        series["nodes"][norm] += sign * n["count"]
+        per_book = series["names"].setdefault(norm, {})
+        if sign > 0:
+            per_book[book_id] = n["name"]
+        else:
+            per_book.pop(book_id, None)
+    for a, ptr in partners.items():
+        for b, w in ptr.items():
+            if a < b:
+                series["edges"][(a, b)] += sign * w
+    series["nodes"] = +series["nodes"]   # drop zero/negative leftovers
+    series["edges"] = +series["edges"]
+    series["names"] = {n: d for n, d in series["names"].items() if d and n in series["nodes"]}
+    books = set(series["books"])
+    if sign > 0:
+        books.add(book_id)
+    else:
+        books.discard(book_id)
+    series["books"] = sorted(books)
+    if series["books"]:
+        store[key] = series
+    elif key in store:
+        del store[key]
+
+
+def index_book(store, book_id: int, title: str, author: str,
+               nodes: list[dict], edges: list[dict]):
+    """add (or replace) one book's graph in the corpus index"""
+    old = store.get(f"book:{book_id}")
+    if old:
+        _fold_book(store, book_id, old["author"], old["nodes"], old["edges"], -1)
+
+    _fold_book(store, book_id, author, nodes, edges, 1)
+    store[f"book:{book_id}"] = {"title": title, "author": author, "nodes": nodes, "edges": edges}
+
+
+def lookup_character(store, name: str, top_partners: int = 10):
+    entry = store.get(f"char:{norm_name(name)}")
+    if not entry:
+        return {"error": f"no character named {name} in the corpus"}
+    return {
+        "name": entry["name"],
+        "books": [{"book_id": b, "count": c} for b, c in Counter(entry["books"]).most_common()],
+        "top_partners": [
+            {"name": entry["partner_names"].get(p, p), "weight": w}
+            for p, w in Counter(entry["partners"]).most_common(top_partners)
+        ],
+    }
+
 
-    nodes = [{"name": n, "count": c} for n, c in top_nodes]
+def series_graph(store, author: str, opts: GraphOptions | None = None):
+    series = store.get(f"author:{norm_name(author)}")
+    if not series:
+        return {"error": f"no books by {author} in the corpus"}
+    def display(norm):
+        # latest book's spelling
+        per_book = series["names"].get(norm)
+        return list(per_book.values())[-1] if per_book else norm
+
+    nodes = [{"name": display(n), "count": c} for n, c in series["nodes"].items()]
     edges = [
-        {"source": a, "target": b, "weight": w} for (a, b), w in top_edges
+        {"source": display(a), "target": display(b), "weight": w}
+        for (a, b), w in series["edges"].items()
     ]
-    return nodes, edges
+    out = shape_graph(None, nodes, edges, opts)
+    del out["book_id"]
+    return {"author": series["author"], "books": series["books"], **out}
+
+
+@app.function(max_containers=1, timeout=120)
+def index_writer(book_id: int, title: str, author: str, nodes: list[dict], edges: list[dict]):
+    # one container, one input at a time: the only place corpus_store is written
+    index_book(corpus_store, book_id, title, author, nodes, edges)
 
 
+def store_graph(book_id: int, title: str, author: str, nodes: list[dict], edges: list[dict]):
+    # indexing is a side effect, never fail (or wait on) the analysis because of it
+    try:
+        index_writer.spawn(book_id, title, author, nodes, edges)
+    except Exception as e:
+        print(f"[store_graph] could not index book {book_id}: {e}")
+
 
 @app.function(secrets=[secret_apis], timeout=600)
-def count_interactions_llm(text: str, book_id: int, max_chunks: int = 5):
+def count_interactions_llm(text: str, book_id: int, max_chunks: int = 5,
+                           opts: GraphOptions | None = None):
     meta   = get_meta_data(book_id)
     title  = meta.get("Title", f"Gutenberg #{book_id}")
     author = meta.get("Author", "Unknown")
@@ -243,85 +704,78 @@ def count_interactions_llm(text: str, book_id: int, max_chunks: int = 5):
     chunks  = make_chunks(excerpt, max_chunks)
     sys_prompt = build_system_prompt(title, author)
 
-    results = [analyse_chunk(ch, sys_prompt) for ch in chunks]
-    nodes, edges = merge(results)
+    nodes, edges = analyse_chunks(chunks, sys_prompt)
 
     # ---- final clean-up ----
     nodes, edges = clean_graph_with_llm(nodes, edges, title, author)
 
-    return {"book_id": book_id, "nodes": nodes, "edges": edges}
+    store_graph(book_id, title, author, nodes, edges)
+    return shape_graph(book_id, nodes, edges, opts)
 
 
-@app.function(secrets=[secret_apis], timeout=300, scaledown_window=60)
-def spacy_count(raw_text: str, book_id: int = 1324):
+@app.function(secrets=[secret_apis], timeout=600)
+def count_interactions_hybrid(text: str, book_id: int, token_budget: int = HYBRID_TOKEN_BUDGET,
+                              opts: GraphOptions | None = None):
     """
-    takes in a book and returns raw spaCy "PERSON" counts.
-    Using lighter model and optimized processing.
-    also returns pairs of "interactoins"
+    spaCy pass over the whole book first, then only the densest passages go to
+    the LLM. names from both are aliased together and the larger of the
+    spaCy / LLM weight is kept per node and pair.
     """
-    print(f"\nProcessing {book_id} ")
-    print(f"Input text length: {len(raw_text)} characters")
-    
-
-    import spacy
-    print("\nInitializing spaCy...")
-    # Use smaller CPU-optimized model
-    nlp = spacy.load("en_core_web_sm", disable=["tagger", "parser", "attribute_ruler", "lemmatizer"])
-    nlp.add_pipe("sentencizer")
-
-
-
-    print("Model loaded successfully")
+    meta   = get_meta_data(book_id)
+    title  = meta.get("Title", f"Gutenberg #{book_id}")
+    author = meta.get("Author", "Unknown")
 
-    
-    blocks = [raw_text[i:i+50000] for i in range(0, len(raw_text), 50000)]
-    print(f"\nSplit text into {len(blocks)} blocks")
-    
-    # spans = []
     t0 = time.perf_counter()
+    mention_counter, pair_counter, passage_pairs = spacy_cooccurrence(text)
+    print(f"\nspaCy NER finished in {time.perf_counter() - t0:.2f}s.")
 
-    
-    print("\nProcessing blocks through spaCy pipeline...")
+    picked = pick_passages(text, passage_pairs, token_budget)
+    sys_prompt = build_system_prompt(title, author)
+    passages = [passage_text(text, idx) for idx in picked]
+    llm_nodes, llm_edges = analyse_chunks(passages, sys_prompt)
 
+    spacy_nodes = [{"name": n, "count": c} for n, c in mention_counter.items()]
+    spacy_edges = [{"source": a, "target": b, "weight": w} for (a, b), w in pair_counter.items()]
 
+    # ---- final clean-up ----
+    # one alias map for both sides so "Elizabeth" (spaCy) and
+    # "Elizabeth Bennet" (LLM) end up as the same node before combining
+    # only the main spaCy cast (most mentions first) plus the LLM's names,
+    # the full PERSON list would overflow the reply and lose the main cast
+    top_spacy = [{"name": n, "count": c} for n, c in mention_counter.most_common(ALIAS_NAMES)]
+    new_names = [n for n in llm_nodes if n["name"] not in mention_counter]
+    mapping = alias_map(top_spacy + new_names, title, author)
+    node_ctr, edge_ctr = apply_alias_map(spacy_nodes, spacy_edges, mapping)
+    llm_node_ctr, llm_edge_ctr = apply_alias_map(llm_nodes, llm_edges, mapping)
 
-    # for i, doc in enumerate(nlp.pipe(blocks, batch_size=2048)):
-    #     block_spans = [(ent.text, ent.start_char, ent.end_char)
-    #                   for ent in doc.ents if ent.label_ == "PERSON"]
-    #     spans += block_spans
-    #     print(f"Block {i+1}/{len(blocks)}: Found {len(block_spans)} PERSON entities")
+    # spaCy counts the whole book, the LLM only a few passages, so take the
+    # larger of the two rather than letting the passage count replace the total
+    for n, c in llm_node_ctr.items():
+        node_ctr[n] = max(node_ctr[n], c)
+    for pair, w in llm_edge_ctr.items():
+        edge_ctr[pair] = max(edge_ctr[pair], w)
 
-    mention_counter: Counter[str] = Counter()
-    # Use a simple Counter to tally pair interactions
-    pair_counter: Counter[tuple[str, str]] = Counter()
-    
-    # we create two counters for each of pairs and overall number of mentions
-    
-    
-    
-    from itertools import combinations
+    nodes, edges = top_graph(node_ctr, edge_ctr)
 
+    store_graph(book_id, title, author, nodes, edges)
+    return shape_graph(book_id, nodes, edges, opts)
 
-    
-    for i, doc in enumerate(nlp.pipe(blocks, batch_size=2048)):
-        # Count overall mentions across the block
-        for ent in doc.ents:
-            if ent.label_ == "PERSON":
-                mention_counter[ent.text.strip()] += 1
 
-        # Count interactions per sentence 
-        for sent in doc.sents:
-            names = {e.text.strip() for e in sent.ents if e.label_ == "PERSON"}
-            if len(names) > 1:
-                for n1, n2 in combinations(sorted(list(names)), 2):
-                    pair_counter[(n1, n2)] += 1 
-        
+@app.function(secrets=[secret_apis], timeout=300, scaledown_window=60)
+def spacy_count(raw_text: str, book_id: int = 1324, opts: GraphOptions | None = None):
+    """
+    takes in a book and returns raw spaCy "PERSON" counts.
+    Using lighter model and optimized processing.
+    also returns pairs of "interactoins"
+    """
+    print(f"\nProcessing {book_id} ")
+    print(f"Input text length: {len(raw_text)} characters")
     
 
+    t0 = time.perf_counter()
+    print("\nProcessing blocks through spaCy pipeline...")
+    mention_counter, pair_counter, _ = spacy_cooccurrence(raw_text)
 
-
-    
-              
     print(f"\nspaCy NER finished in {time.perf_counter() - t0:.2f}s.")
 
 
@@ -353,26 +807,99 @@ def spacy_count(raw_text: str, book_id: int = 1324):
     print("\nCleaning spaCy results with LLM...")
     nodes, edges = clean_graph_with_llm(nodes, edges, title, author)
 
-    return {"book_id": book_id, "nodes": nodes, "edges": edges}
+    store_graph(book_id, title, author, nodes, edges)
+    return shape_graph(book_id, nodes, edges, opts)
 
 
 
 
-@app.function()
-@modal.fastapi_endpoint(method="POST", docs=True)
-def analyze_book(req: AnalysisRequest):
+_mode_slots = {mode: threading.BoundedSemaphore(n) for mode, n in MODE_LIMITS.items()}
+
+
+@contextmanager
+def admit(mode: str, timeout: float | None = None):
+    """
+    wait up to timeout for a free slot for this mode, otherwise tell the
+    client to back off (429) instead of piling more work on spaCy/OpenAI
+    """
+    timeout = ADMISSION_TIMEOUT if timeout is None else timeout
+    slot = _mode_slots[mode]
+    if not slot.acquire(timeout=timeout):
+        raise HTTPException(
+            status_code=429,
+            detail=f"too many {mode} analyses running, try again shortly",
+            headers={"Retry-After": str(max(1, math.ceil(timeout)))},
+        )
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+def handle_analysis(req: AnalysisRequest, accept_encoding: str = "", local: bool = False):
+    # local=True runs the modal functions in this process (used by loadtest.py)
+    call = (lambda f, *a, **k: f.local(*a, **k)) if local else (lambda f, *a, **k: f.remote(*a, **k))
 
     if req.analysis_type == "metadata":
         return get_meta_data(req.gutenberg_id)
-    
-    txt = get_text(req.gutenberg_id)
-    if isinstance(txt, dict) and "error" in txt:
-        return txt
-    
-    if req.analysis_type == "spacy":
-        return spacy_count.remote(txt, req.gutenberg_id)
 
-    return count_interactions_llm.remote(txt, req.gutenberg_id, req.max_chunks)
+    with admit(req.analysis_type):
+        txt = get_text(req.gutenberg_id)
+        if isinstance(txt, dict) and "error" in txt:
+            return txt
+
+        if req.analysis_type == "spacy":
+            out = call(spacy_count, txt, req.gutenberg_id, opts=req)
+        elif req.analysis_type == "hybrid":
+            out = call(count_interactions_hybrid, txt, req.gutenberg_id, opts=req)
+        else:
+            out = call(count_interactions_llm, txt, req.gutenberg_id, req.max_chunks, opts=req)
+
+    return encode_response(out, accept_encoding, req.wire_format)
+
+
+# one container so the per-mode limits above are global, it only dispatches
+# to the remote functions so concurrent inputs are cheap.
+# max_inputs covers every running analysis plus ADMISSION_QUEUE waiting ones.
+# anything past it is queued by Modal with no timeout and never sees the 429,
+# so raise ADMISSION_QUEUE rather than lowering this
+@app.function(max_containers=1)
+@modal.concurrent(max_inputs=sum(MODE_LIMITS.values()) + ADMISSION_QUEUE)
+@modal.fastapi_endpoint(method="POST", docs=True)
+def analyze_book(req: AnalysisRequest, request: Request):
+    return handle_analysis(req, request.headers.get("accept-encoding", ""))
+
+
+@app.function()
+@modal.fastapi_endpoint(method="POST", docs=True)
+def corpus(req: CorpusRequest, request: Request):
+
+    if req.query_type == "character":
+        if not req.name:
+            return {"error": "name is required for character lookups"}
+        out = lookup_character(corpus_store, req.name, req.top_partners)
+
+    elif req.query_type == "author":
+        name = req.name
+        if not name and req.gutenberg_id is not None:
+            book = corpus_store.get(f"book:{req.gutenberg_id}")
+            name = book["author"] if book else get_meta_data(req.gutenberg_id)["Author"]
+        if not name:
+            return {"error": "name or gutenberg_id is required for author graphs"}
+        out = series_graph(corpus_store, name, req)
+
+    else:
+        if req.gutenberg_id is None:
+            return {"error": "gutenberg_id is required for book lookups"}
+        book = corpus_store.get(f"book:{req.gutenberg_id}")
+        if not book:
+            return {"error": f"book {req.gutenberg_id} has not been analysed yet"}
+        out = {"title": book["title"], "author": book["author"],
+               **shape_graph(req.gutenberg_id, book["nodes"], book["edges"], req)}
+
+    if "error" in out:
+        return out
+    return encode_response(out, request.headers.get("accept-encoding", ""))
 
 
 @app.local_entrypoint()